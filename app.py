@@ -55,6 +55,12 @@ def check_setup() -> tuple[bool, str]:
     return True, "System ready!"
 
 
+@st.cache_data(ttl=60)
+def _count() -> int:
+    """Get the number of indexed chunks (refreshed at most once a minute)."""
+    return get_collection().count()
+
+
 def display_sources(sources: list[dict]):
     """Display retrieved source chunks."""
     st.subheader("📚 检索资源")
@@ -93,6 +99,41 @@ def display_sources(sources: list[dict]):
             st.markdown(source["document"])
 
 
+def display_result(result: dict):
+    """Display the answer (streaming it in if it is still being generated) and its sources."""
+    st.markdown("---")
+    
+    # Answer section
+    st.subheader("💬 搜索结果")
+    if result.get("cached"):
+        st.caption("⚡ 缓存命中 (cached answer)")
+    if isinstance(result["answer"], str):
+        st.markdown(result["answer"])
+    else:
+        # A rerun (e.g. a widget click) can interrupt streaming at any point, so the parts
+        # received so far are kept and shown again before the stream is resumed
+        parts = result.setdefault("answer_parts", [])
+        received = "".join(parts)
+        
+        def stream():
+            if received:
+                yield received
+            for part in result["answer"]:
+                parts.append(part)
+                yield part
+        
+        st.write_stream(stream())
+        
+        # Keep the full text, so later reruns redisplay it without the API
+        result["answer"] = "".join(parts)
+        del result["answer_parts"]
+    
+    st.markdown("---")
+    
+    # Sources section
+    display_sources(result["sources"])
+
+
 def main():
     """Main application."""
     st.title("🚇 浙江省市政工程预算定额辅助查询平台")
@@ -147,8 +188,7 @@ def main():
         st.markdown("---")
         st.markdown("### 📊 系统信息")
         try:
-            collection = get_collection()
-            st.metric("索引块", collection.count())
+            st.metric("索引块", _count())
         except Exception as e:
             st.warning("Could not load collection stats")
     
@@ -177,26 +217,21 @@ def main():
     if search_button and query:
         with st.spinner("🔍 答案生成中..."):
             try:
-                result = query_rag(query, n_results=n_results)
+                result = query_rag(query, n_results=n_results, stream=True)
                 st.session_state.result = result
+                st.session_state.cache = "HIT" if result.get("cached") else "MISS"
             except Exception as e:
                 st.error(f"Error processing query: {str(e)}")
                 return
     
     # Display results
     if "result" in st.session_state:
-        result = st.session_state.result
-        
-        st.markdown("---")
-        
-        # Answer section
-        st.subheader("💬 搜索结果")
-        st.markdown(result["answer"])
-        
-        st.markdown("---")
-        
-        # Sources section
-        display_sources(result["sources"])
+        try:
+            display_result(st.session_state.result)
+        except Exception as e:
+            # The answer failed mid-stream; don't redisplay a partial result
+            st.session_state.pop("result", None)
+            st.error(f"Error processing query: {str(e)}")
 
 
 if __name__ == "__main__":
@@ -1,7 +1,105 @@
 """Table-aware chunking for budget documents with cross-page table handling."""
 
 import re
-from typing import Optional
+from itertools import accumulate, islice
+from typing import Iterable, Iterator, Optional
+
+
+# Leading \s* matches exactly what str.strip() would remove, so lines need no stripping
+_SEP_RE = re.compile(r"\s*\|[\s\-:]+\|")
+_ROW_RE = re.compile(r"\s*\|")
+_HDR_RE = re.compile(r"\s*#")
+_BLANK_RE = re.compile(r"\s*$")
+_SPACE_RE = re.compile(r"\s*")
+# One probe per line: the matching group number is the line kind
+_LINE_RE = re.compile(r"\s*(?:(\|[\s\-:]+\|)|(\|)|(#))")
+
+# Line kinds produced by TableAwareChunker._classify_lines
+# (numbered after the groups of _LINE_RE)
+_PLAIN, _TABLE_SEPARATOR, _TABLE_ROW, _HEADING = range(4)
+
+# Number of trailing lines repeated at the start of the next chunk
+OVERLAP_LINES = 5
+
+
+def format_context_header(meta: dict) -> str:
+    """Format the "[Source {i}: Page X - Section]" line introducing a chunk in the prompt.
+    
+    `{i}` is left in place for the source number, which is only known per query.
+    """
+    start_page = meta.get("start_page", "?")
+    end_page = meta.get("end_page", start_page)
+    if start_page == end_page:
+        page_info = f"Page {start_page}"
+    else:
+        page_info = f"Pages {start_page}-{end_page}"
+    
+    section = meta.get("section", "")
+    section_info = f" - {section}" if section else ""
+    
+    return f"[Source {{i}}: {page_info}{section_info}]"
+
+
+def _iter_lines(text: str, start: int = 0) -> Iterator[str]:
+    """Yield the lines of text[start:] one at a time, without splitting it all up front."""
+    while True:
+        end = text.find("\n", start)
+        if end == -1:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 1
+
+
+def _select_boundaries(kinds: bytes, widths: list[int], max_size: int,
+                       overlap_lines: int) -> list[tuple[int, int, int, int, int]]:
+    """Pick chunk boundaries from line kinds and widths alone.
+    
+    Returns one (start, end, prefix_header, table_header, section) tuple per chunk.
+    A chunk is lines[start:end], preceded by the header row at `prefix_header` and
+    its separator when it continues a table. `table_header` and `section` are the
+    line indices of the table header and heading in effect (-1 for none). The last
+    tuple is the remainder after the final full chunk.
+    """
+    boundaries = []
+    n = len(kinds)
+    offsets = list(accumulate(widths, initial=0))  # offsets[k] = total width of lines[:k]
+    next_kinds = kinds[1:] + bytes([_PLAIN])  # kind of the following line, no bounds check
+    start = 0
+    prefix_header = -1
+    table_header = -1
+    table_header_width = 0
+    section = -1
+    # The chunk is full once offsets[i + 1] reaches this; it only changes on a flush,
+    # so the per-line check is one comparison instead of a running size update
+    flush_at = max_size
+    
+    for i in range(n):
+        kind = kinds[i]
+        is_table_row = kind == _TABLE_ROW or kind == _TABLE_SEPARATOR
+        
+        # Track section headers
+        if kind == _HEADING:
+            section = i
+        
+        # Detect table header (a row followed by a separator)
+        if is_table_row and next_kinds[i] == _TABLE_SEPARATOR:
+            table_header = i
+            table_header_width = widths[i] + widths[i + 1]
+        
+        # Check if chunk is full
+        if offsets[i + 1] >= flush_at:
+            boundaries.append((start, i + 1, prefix_header, table_header, section))
+            
+            # Start new chunk with overlap, and the table header if we're in a table
+            start = max(start, i + 1 - overlap_lines)
+            prefix_header = table_header if is_table_row else -1
+            flush_at = offsets[start] + max_size
+            if prefix_header >= 0:
+                flush_at -= table_header_width
+    
+    boundaries.append((start, n, prefix_header, table_header, section))
+    return boundaries
 
 
 class TableAwareChunker:
@@ -13,35 +111,22 @@ class TableAwareChunker:
     
     def _is_table_row(self, line: str) -> bool:
         """Check if a line is a table row (contains | characters)."""
-        return "|" in line and line.strip().startswith("|")
+        return _ROW_RE.match(line) is not None
     
     def _is_table_separator(self, line: str) -> bool:
         """Check if a line is a table separator (|---|---|)."""
-        return bool(re.match(r"^\|[\s\-:]+\|", line.strip()))
-    
-    def _is_table_header(self, line: str, next_line: Optional[str] = None) -> bool:
-        """Check if a line is a table header (followed by separator)."""
-        if not self._is_table_row(line):
-            return False
-        if next_line and self._is_table_separator(next_line):
-            return True
-        return False
+        return _SEP_RE.match(line) is not None
     
     def _is_table_continuation(self, text: str) -> bool:
         """Check if text starts with table rows but no header."""
-        lines = text.strip().split("\n")
-        if not lines:
-            return False
-        
-        # Look at first few non-empty lines
+        # Look at first few non-empty lines (skipping leading whitespace, as strip() would)
         table_rows = []
-        for line in lines[:5]:
-            line = line.strip()
-            if not line:
+        for line in islice(_iter_lines(text, _SPACE_RE.match(text).end()), 5):
+            if _BLANK_RE.match(line):
                 continue
             if self._is_table_row(line):
                 table_rows.append(line)
-            elif line.startswith("#"):
+            elif _HDR_RE.match(line):
                 return False  # Starts with heading, not continuation
             else:
                 break
@@ -55,29 +140,24 @@ class TableAwareChunker:
     
     def _table_is_complete(self, text: str) -> bool:
         """Check if text ends with a complete table (or no table)."""
-        lines = text.strip().split("\n")
-        if not lines:
-            return True
-        
-        # Find last table row
-        last_table_idx = -1
-        for i in range(len(lines) - 1, -1, -1):
-            if self._is_table_row(lines[i]):
-                last_table_idx = i
-                break
-        
-        if last_table_idx == -1:
-            return True  # No table found
-        
-        # Check if there's content after the last table row
-        for i in range(last_table_idx + 1, len(lines)):
-            line = lines[i].strip()
-            if line and not self._is_table_row(line):
-                return True  # Non-table content after table
+        # Walk lines backwards to the last table row, without splitting the whole text
+        content_after_table = False
+        end = len(text)
+        while end >= 0:
+            start = text.rfind("\n", 0, end) + 1
+            line = text[start:end]
+            if self._is_table_row(line):
+                if content_after_table:
+                    return True  # Non-table content after table
+                
+                # Table is at the end - check if it looks complete
+                # (This is heuristic - a table ending mid-page might still be complete)
+                return True
+            if not _BLANK_RE.match(line):
+                content_after_table = True
+            end = start - 1
         
-        # Table is at the end - check if it looks complete
-        # (This is heuristic - a table ending mid-page might still be complete)
-        return True
+        return True  # No table found
     
     def _extract_table_header(self, text: str) -> Optional[str]:
         """Extract the table header (first row + separator) from text."""
@@ -94,12 +174,15 @@ class TableAwareChunker:
         
         return None
     
-    def merge_cross_page_tables(self, pages: list[dict]) -> list[dict]:
-        """Detect and merge tables that span multiple pages."""
-        if not pages:
-            return []
+    def _classify_lines(self, lines: list[str]) -> bytes:
+        """Classify every line in one pass (table row, separator, heading or plain)."""
+        return bytes(m.lastindex if m else _PLAIN for m in map(_LINE_RE.match, lines))
+    
+    def iter_merged_pages(self, pages: Iterable[dict]) -> Iterator[dict]:
+        """Detect and merge tables that span multiple pages, yielding merged pages as they complete.
         
-        merged = []
+        Only the page being merged into is buffered, so `pages` can be a stream.
+        """
         pending = None
         
         for page in pages:
@@ -114,9 +197,9 @@ class TableAwareChunker:
                 pending["text"] += "\n" + text
                 pending["end_page"] = page_num
             else:
-                # Save pending if exists
+                # Emit pending if exists
                 if pending:
-                    merged.append(pending)
+                    yield pending
                 
                 # Start new pending
                 pending = {
@@ -127,87 +210,50 @@ class TableAwareChunker:
         
         # Don't forget the last pending
         if pending:
-            merged.append(pending)
-        
-        return merged
+            yield pending
+    
+    def merge_cross_page_tables(self, pages: list[dict]) -> list[dict]:
+        """Detect and merge tables that span multiple pages."""
+        return list(self.iter_merged_pages(pages))
     
     def chunk_with_table_context(self, text: str, metadata: dict) -> list[dict]:
         """Chunk text while preserving table headers in each chunk."""
-        chunks = []
-        current_section = metadata.get("section", "")
-        current_table_header = None
-        
         lines = text.split("\n")
-        current_chunk_lines = []
-        current_size = 0
+        kinds = self._classify_lines(lines)
+        widths = [len(line) + 1 for line in lines]  # +1 for newline
+        boundaries = _select_boundaries(kinds, widths, self.max_chunk_size, OVERLAP_LINES)
         
-        i = 0
-        while i < len(lines):
-            line = lines[i]
-            
-            # Track section headers
-            if line.strip().startswith("#"):
-                current_section = line.strip().lstrip("#").strip()
-            
-            # Detect table header
-            next_line = lines[i + 1] if i + 1 < len(lines) else None
-            if self._is_table_header(line, next_line):
-                current_table_header = line + "\n" + next_line
-            
-            # Add line to current chunk
-            current_chunk_lines.append(line)
-            current_size += len(line) + 1  # +1 for newline
+        chunks = []
+        last = len(boundaries) - 1
+        for n, (start, end, prefix_header, table_header, section) in enumerate(boundaries):
+            chunk_lines = lines[start:end]
+            # Prepend table header if the chunk continues a table
+            if prefix_header >= 0:
+                chunk_lines = lines[prefix_header:prefix_header + 2] + chunk_lines
+            chunk_text = "\n".join(chunk_lines)
             
-            # Check if chunk is full
-            if current_size >= self.max_chunk_size:
-                chunk_text = "\n".join(current_chunk_lines)
-                
-                chunks.append({
-                    "text": chunk_text,
-                    "section": current_section,
-                    "table_header": current_table_header,
-                    **metadata
-                })
-                
-                # Start new chunk with overlap and table context
-                overlap_start = max(0, len(current_chunk_lines) - 5)  # Keep last 5 lines for overlap
-                current_chunk_lines = current_chunk_lines[overlap_start:]
-                
-                # Prepend table header if we're in a table
-                if current_table_header and self._is_table_row(line):
-                    header_lines = current_table_header.split("\n")
-                    current_chunk_lines = header_lines + current_chunk_lines
-                
-                current_size = sum(len(l) + 1 for l in current_chunk_lines)
+            # Don't emit a trailing whitespace-only remainder
+            if n == last and not chunk_text.strip():
+                continue
             
-            i += 1
-        
-        # Don't forget the last chunk
-        if current_chunk_lines:
-            chunk_text = "\n".join(current_chunk_lines)
-            if chunk_text.strip():
-                chunks.append({
-                    "text": chunk_text,
-                    "section": current_section,
-                    "table_header": current_table_header,
-                    **metadata
-                })
+            chunks.append({
+                "text": chunk_text,
+                "section": lines[section].strip().lstrip("#").strip() if section >= 0 else metadata.get("section", ""),
+                "table_header": lines[table_header] + "\n" + lines[table_header + 1] if table_header >= 0 else None,
+                **metadata
+            })
         
         return chunks
     
-    def process_pages(self, pages: list[dict]) -> list[dict]:
-        """Full processing pipeline: merge tables, then chunk."""
-        # Step 1: Merge cross-page tables
-        merged_pages = self.merge_cross_page_tables(pages)
-        
-        # Step 2: Chunk each merged section
-        all_chunks = []
-        for page_data in merged_pages:
+    def stream(self, pages: Iterable[dict]) -> Iterator[dict]:
+        """Merge tables, then chunk, yielding chunks as soon as their pages arrive."""
+        for page_data in self.iter_merged_pages(pages):
             metadata = {
                 "start_page": page_data["start_page"],
                 "end_page": page_data["end_page"]
             }
-            chunks = self.chunk_with_table_context(page_data["text"], metadata)
-            all_chunks.extend(chunks)
-        
-        return all_chunks
+            yield from self.chunk_with_table_context(page_data["text"], metadata)
+    
+    def process_pages(self, pages: list[dict]) -> list[dict]:
+        """Full processing pipeline: merge tables, then chunk."""
+        return list(self.stream(pages))
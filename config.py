@@ -22,15 +22,46 @@ CHAT_MODEL = "mistral-large-latest"
 BASE_DIR = Path(__file__).parent
 DATA_DIR = BASE_DIR / "data"
 VECTORSTORE_DIR = BASE_DIR / "vectorstore"
+ANSWER_CACHE_DIR = VECTORSTORE_DIR / "answer_cache"
+TABLE_HEADERS_FILE = "table_headers.json"  # Table header ID -> header, next to the collection
 PDF_PATH = DATA_DIR / "Tunnel budget.pdf"
 
 # Chunking Configuration
 MAX_CHUNK_SIZE = 1500  # characters
 CHUNK_OVERLAP = 200    # characters
 
+# API Concurrency Configuration
+OCR_CONCURRENCY = 8    # Max concurrent OCR page requests
+OCR_UPLOAD_MAX_BYTES = 50 * 1024 * 1024  # Larger PDFs are sent page by page
+EMBEDDING_CONCURRENCY = 8  # Max concurrent embedding requests per call
+EMBEDDING_BATCH_SIZE = 32  # Max texts per query-side embedding request
+EMBEDDING_BATCH_CHARS = 8000  # Max characters per query-side embedding request
+INSERT_WORKERS = 4     # Parallel vector store insert batches
+API_MAX_RETRIES = 5    # Retries (with exponential backoff) on rate limiting
+HTTP_MAX_CONNECTIONS = 64  # Pooled connections per query-side HTTP client (HTTP/2)
+HTTP_MAX_KEEPALIVE = 32    # Idle connections kept open for reuse
+
+# Vector Index Configuration (HNSW)
+HNSW_M = 16                 # Graph links per node (set when the collection is created)
+HNSW_CONSTRUCTION_EF = 200  # Candidate list size while building (set when the collection is created)
+HNSW_SEARCH_EF = 64         # Candidate list size per query (higher = better recall, slower)
+
 # RAG Configuration
 TOP_K_RESULTS = 5      # Number of chunks to retrieve
 TEMPERATURE = 0.1      # Low temperature for factual answers
+MAX_SOURCE_CHARS = 1200   # Longer sources are cut to their head and tail in the prompt
+MAX_CONTEXT_CHARS = 8000  # Total source characters per prompt, closest sources first
+QUERY_TIMEOUT = 120       # Seconds a query may take (retrieval + generation) before it fails
+
+# Query Batching Configuration
+QUERY_BATCH_WINDOW_MS = 75  # Wait for concurrent queries to share one embedding request
+QUERY_MAX_BATCH = 16        # Max queries per batch
+
+# Semantic Cache Configuration
+SEMANTIC_CACHE_DISTANCE = 0.15  # Max cosine distance for a cached answer to be reused
+SEMANTIC_CACHE_TTL = 24 * 3600  # Seconds before a cached answer expires
+QUERY_EMBEDDING_CACHE_SIZE = 1024  # Recent query embeddings kept in memory
+ANSWER_CACHE_TTL = 3600  # Seconds an exact-repeat answer is shared across workers
 
 # Ensure directories exist
 DATA_DIR.mkdir(exist_ok=True)
@@ -1,13 +1,24 @@
 """Document ingestion pipeline: OCR -> Chunking -> Embedding -> Vector Store."""
 
+import asyncio
 import base64
-import json
+import hashlib
 import io
-import time
+import multiprocessing
+import os
+import queue
+import shutil
+import sqlite3
+import threading
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Callable, Iterable, Iterator
 from mistralai import Mistral
 import chromadb
 import fitz  # PyMuPDF
+import orjson
 
 from config import (
     MISTRAL_API_KEY,
@@ -15,18 +26,120 @@ from config import (
     EMBEDDING_MODEL,
     PDF_PATH,
     VECTORSTORE_DIR,
+    ANSWER_CACHE_DIR,
+    TABLE_HEADERS_FILE,
+    HNSW_M,
+    HNSW_CONSTRUCTION_EF,
+    HNSW_SEARCH_EF,
     MAX_CHUNK_SIZE,
-    CHUNK_OVERLAP
+    CHUNK_OVERLAP,
+    OCR_CONCURRENCY,
+    OCR_UPLOAD_MAX_BYTES,
+    EMBEDDING_CONCURRENCY,
+    INSERT_WORKERS,
+    API_MAX_RETRIES
 )
-from chunker import TableAwareChunker
+from chunker import TableAwareChunker, format_context_header
+
+
+class EmbeddingCache:
+    """SQLite-backed store of embeddings keyed by a hash of the model and text."""
+    
+    def __init__(self, path: Path, model: str):
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (hash BLOB PRIMARY KEY, vec BLOB NOT NULL)"
+        )
+        self.conn.commit()
+        self.model_key = model.encode("utf-8")
+        self.lock = threading.Lock()  # the connection is shared by the insert workers
+    
+    def key(self, text: str) -> bytes:
+        """Hash a text into its cache key (changing the model invalidates all keys)."""
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16, key=self.model_key).digest()
+    
+    def get_many(self, keys: list[bytes]) -> dict[bytes, list[float]]:
+        """Look up the cached embeddings for the given keys, skipping misses."""
+        found = {}
+        unique_keys = list(set(keys))
+        with self.lock:
+            # Stay below SQLite's limit on bound parameters
+            for i in range(0, len(unique_keys), 500):
+                group = unique_keys[i:i + 500]
+                rows = self.conn.execute(
+                    f"SELECT hash, vec FROM embeddings WHERE hash IN ({','.join('?' * len(group))})",
+                    group
+                )
+                for key, vec in rows:
+                    found[key] = array("f", vec).tolist()
+        return found
+    
+    def put_many(self, items: list[tuple[bytes, list[float]]]):
+        """Store embeddings as float32 blobs."""
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (hash, vec) VALUES (?, ?)",
+                [(key, array("f", embedding).tobytes()) for key, embedding in items]
+            )
+            self.conn.commit()
 
 
 class MistralEmbeddingFunction:
     """Custom embedding function for ChromaDB using Mistral."""
     
-    def __init__(self, api_key: str):
-        self.client = Mistral(api_key=api_key)
+    def __init__(self, api_key: str, concurrency: int = EMBEDDING_CONCURRENCY, cache: EmbeddingCache = None):
+        self.api_key = api_key
         self.model = EMBEDDING_MODEL
+        self.concurrency = concurrency
+        self.cache = cache
+    
+    async def _aembed_batch(self, client: Mistral, semaphore: asyncio.Semaphore, batch: list[str]) -> list[list[float]]:
+        """Embed a single batch, sharing the concurrency cap with the other batches."""
+        response = await _bounded(
+            semaphore,
+            lambda: client.embeddings.create_async(model=self.model, inputs=batch)
+        )
+        return [item.embedding for item in response.data]
+    
+    async def _aembed_uncached(self, input: list[str]) -> list[list[float]]:
+        """Request embeddings for a list of texts, sending all batches concurrently."""
+        # Mistral has a limit on batch size, process in batches
+        batch_size = 10
+        batches = [input[i:i + batch_size] for i in range(0, len(input), batch_size)]
+        semaphore = asyncio.Semaphore(self.concurrency)
+        
+        # The async HTTP client is bound to the running event loop, so it is
+        # opened per call rather than shared across asyncio.run() invocations
+        async with Mistral(api_key=self.api_key) as client:
+            results = await asyncio.gather(
+                *[self._aembed_batch(client, semaphore, batch) for batch in batches]
+            )
+        
+        return [embedding for batch_embeddings in results for embedding in batch_embeddings]
+    
+    async def aembed(self, input: list[str]) -> list[list[float]]:
+        """Generate embeddings for a list of texts, requesting only those not in the cache."""
+        if not input:
+            return []
+        if self.cache is None:
+            return await self._aembed_uncached(input)
+        
+        keys = [self.cache.key(text) for text in input]
+        found = self.cache.get_many(keys)
+        
+        # Embed each missing text once, even if it appears several times
+        missing = {}
+        for key, text in zip(keys, input):
+            if key not in found:
+                missing.setdefault(key, text)
+        if missing:
+            embeddings = await self._aembed_uncached(list(missing.values()))
+            new_items = list(zip(missing.keys(), embeddings))
+            self.cache.put_many(new_items)
+            found.update(new_items)
+        
+        return [found[key] for key in keys]
     
     def __call__(self, input: list[str]) -> list[list[float]]:
         """Generate embeddings for a list of texts."""
@@ -34,194 +147,485 @@ class MistralEmbeddingFunction:
         if not input:
             return []
         
-        # Mistral has a limit on batch size, process in batches
-        batch_size = 10
-        all_embeddings = []
+        return asyncio.run(self.aembed(input))
+
+
+_worker_docs = {}  # pdf_path -> open document, per worker process
+
+
+def _extract_page_pdf_b64(pdf_path: str, page_num: int) -> str:
+    """Copy a single page of a PDF into a standalone PDF and base64-encode it.
+    
+    Runs in a worker process; each worker keeps its own open handle to the source PDF.
+    """
+    doc = _worker_docs.get(pdf_path)
+    if doc is None:
+        doc = _worker_docs[pdf_path] = fitz.open(pdf_path)
+    
+    single_page_doc = fitz.open()
+    single_page_doc.insert_pdf(doc, from_page=page_num, to_page=page_num)
+    pdf_bytes = single_page_doc.tobytes()
+    single_page_doc.close()
+    
+    return base64.standard_b64encode(pdf_bytes).decode("utf-8")
+
+
+async def _upload_pdf(client: Mistral, pdf_path: Path) -> tuple[str, str]:
+    """Upload the whole PDF once for OCR, returning its file ID and a signed URL."""
+    with open(pdf_path, "rb") as f:
+        content = f.read()
+    
+    uploaded = await client.files.upload_async(
+        file={"file_name": pdf_path.name, "content": content},
+        purpose="ocr"
+    )
+    signed_url = await client.files.get_signed_url_async(file_id=uploaded.id)
+    return uploaded.id, signed_url.url
+
+
+async def _ocr_page_async(client: Mistral, document_url: str, page_num: int, pages: list[int] = None) -> dict:
+    """Run Mistral OCR on one page of a document.
+    
+    `document_url` is either the uploaded PDF (with `pages` selecting the page) or a
+    base64 data URL of a single-page PDF.
+    """
+    options = {"pages": pages} if pages is not None else {}
+    response = await client.ocr.process_async(
+        model=OCR_MODEL,
+        document={
+            "type": "document_url",
+            "document_url": document_url
+        },
+        **options
+    )
+    
+    # Extract text from response
+    if response.pages:
+        page_text = response.pages[0].markdown
+    else:
+        page_text = ""
+    
+    return {
+        "page": page_num + 1,
+        "text": page_text
+    }
+
+
+def _is_rate_limited(error: Exception) -> bool:
+    """Check if an API error was caused by rate limiting."""
+    error_msg = str(error)
+    return "429" in error_msg or "rate" in error_msg.lower()
+
+
+async def _bounded(semaphore: asyncio.Semaphore, make_request, max_retries: int = API_MAX_RETRIES):
+    """Await a request while holding a concurrency slot, backing off on rate limits.
+    
+    `make_request` is called again for every attempt, since a coroutine can only be awaited once.
+    """
+    async with semaphore:
+        for attempt in range(max_retries + 1):
+            try:
+                return await make_request()
+            except Exception as e:
+                if attempt == max_retries or not _is_rate_limited(e):
+                    raise
+                delay = 2 ** attempt
+                print(f"    Rate limited, retrying in {delay} seconds...")
+            await asyncio.sleep(delay)
+
+
+def _load_progress(progress_file: Path) -> dict[int, dict]:
+    """Read the page records appended to the progress file, keyed by page index.
+    
+    A last line cut off by an interrupted write is ignored.
+    """
+    pages = {}
+    with open(progress_file, "rb") as f:
+        for line in f:
+            try:
+                page = orjson.loads(line)
+            except ValueError:
+                continue
+            pages[page["page"] - 1] = page
+    return pages
+
+
+async def _ocr_pages_async(
+    pdf_path: Path,
+    total_pages: int,
+    api_key: str,
+    done_pages: dict[int, dict],
+    concurrency: int,
+    progress_file: Path = None,
+    on_page: Callable[[dict], None] = None
+) -> list[int]:
+    """OCR all pages not in `done_pages` with a bounded pool of concurrent requests.
+    
+    `on_page` is called with each page (already done or not) in page order, as soon as
+    it and all earlier pages are done; pages are then dropped (also from `done_pages`),
+    so only out-of-order pages are held in memory. Each successfully OCR'd page is
+    appended to the progress file as one JSON line. Returns the failed page numbers.
+    The PDF is uploaded once and each request selects one of its pages. PDFs too large
+    to upload (or whose upload fails) are sent as single-page payloads instead, prepared
+    in a process pool up to `concurrency` pages ahead of the requests in flight.
+    """
+    pending = [page_num for page_num in range(total_pages) if page_num not in done_pages]
+    results = done_pages  # page_num -> page dict, filled in completion order, emptied in page order
+    next_page = 0  # first page not yet passed to on_page
+    failed_pages = []
+    completed = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    prepare_semaphore = asyncio.Semaphore(2 * concurrency)  # bounds payloads held in memory
+    lock = asyncio.Lock()
+    loop = asyncio.get_running_loop()
+    
+    def emit_ready_pages():
+        nonlocal next_page
+        while next_page in results:
+            page = results.pop(next_page)
+            if on_page:
+                on_page(page)
+            next_page += 1
+    
+    emit_ready_pages()
+    
+    progress = open(progress_file, "ab") if progress_file else None
+    pool = None
+    try:
+        if progress and progress.tell() > 0:
+            progress.write(b"\n")  # never append onto a line cut off by an interrupted write
         
-        for i in range(0, len(input), batch_size):
-            batch = input[i:i + batch_size]
-            response = self.client.embeddings.create(
-                model=self.model,
-                inputs=batch
+        async with Mistral(api_key=api_key) as client:
+            file_id = document_url = None
+            if pdf_path.stat().st_size <= OCR_UPLOAD_MAX_BYTES:
+                try:
+                    file_id, document_url = await _upload_pdf(client, pdf_path)
+                except Exception as e:
+                    print(f"Could not upload PDF, sending pages individually: {str(e)[:80]}")
+            if not document_url:
+                # Spawned rather than forked, as this process already runs OCR, insert and Chroma threads
+                pool = ProcessPoolExecutor(
+                    max_workers=os.cpu_count(),
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            
+            async def process_page(page_num: int):
+                nonlocal completed
+                failed = False
+                try:
+                    if document_url:
+                        page = await _bounded(
+                            semaphore,
+                            lambda: _ocr_page_async(client, document_url, page_num, pages=[page_num])
+                        )
+                    else:
+                        async with prepare_semaphore:
+                            pdf_base64 = await loop.run_in_executor(
+                                pool, _extract_page_pdf_b64, str(pdf_path), page_num
+                            )
+                            page = await _bounded(
+                                semaphore,
+                                lambda: _ocr_page_async(
+                                    client, f"data:application/pdf;base64,{pdf_base64}", page_num
+                                )
+                            )
+                    print(f"  ✓ Page {page_num + 1}/{total_pages} - {len(page['text'])} chars")
+                except Exception as e:
+                    print(f"  ✗ Page {page_num + 1}/{total_pages} - Error: {str(e)[:80]}")
+                    failed = True
+                    page = {
+                        "page": page_num + 1,
+                        "text": f"[OCR failed for page {page_num + 1}]"
+                    }
+                
+                async with lock:
+                    results[page_num] = page
+                    completed += 1
+                    if failed:
+                        failed_pages.append(page_num + 1)
+                    elif progress:
+                        # Failed pages are not recorded, so they are retried on resume
+                        progress.write(orjson.dumps(page) + b"\n")
+                        progress.flush()
+                        if completed % 10 == 0:
+                            print(f"    [Progress saved after {completed} pages]")
+                    
+                    emit_ready_pages()
+            
+            # Let every page finish (OCR failures are handled per page) before surfacing
+            # anything else, e.g. a failed progress write, which would lose that page
+            outcomes = await asyncio.gather(
+                *[process_page(page_num) for page_num in pending],
+                return_exceptions=True
             )
-            batch_embeddings = [item.embedding for item in response.data]
-            all_embeddings.extend(batch_embeddings)
-        
-        return all_embeddings
+            
+            if file_id:
+                try:
+                    await client.files.delete_async(file_id=file_id)
+                except Exception as e:
+                    print(f"Could not delete uploaded PDF {file_id}: {str(e)[:80]}")
+            
+            for outcome in outcomes:
+                if isinstance(outcome, BaseException):
+                    raise outcome
+    finally:
+        if pool:
+            pool.shutdown()
+        if progress:
+            progress.close()
+    
+    # A missing page would look like deleted content to create_vector_store
+    if next_page != total_pages:
+        raise RuntimeError(f"OCR stopped at page {next_page + 1} of {total_pages}")
+    return sorted(failed_pages)
 
 
-def extract_text_with_mistral_ocr(pdf_path: Path, api_key: str, progress_file: Path = None) -> list[dict]:
-    """Extract text from PDF using Mistral OCR API, processing page by page for large PDFs.
+def iter_ocr_pages(
+    pdf_path: Path,
+    api_key: str,
+    progress_file: Path = None,
+    concurrency: int = OCR_CONCURRENCY
+) -> Iterator[dict]:
+    """Extract text from PDF using Mistral OCR API, yielding pages in order as they are done.
     
-    Supports resuming from a progress file if the process was interrupted.
+    Pages are sent as concurrent requests (at most `concurrency` in flight) on a
+    background event loop, so the caller can process earlier pages while later
+    ones are still being OCR'd.
+    Supports resuming from an append-only progress file (one JSON line per page)
+    if the process was interrupted; only the pages missing from it are OCR'd.
     """
     print(f"Starting OCR processing for: {pdf_path}")
     
-    client = Mistral(api_key=api_key)
-    
-    # Open PDF with PyMuPDF
-    doc = fitz.open(pdf_path)
-    total_pages = len(doc)
+    # Open PDF with PyMuPDF (pages are split out by the worker processes)
+    with fitz.open(pdf_path) as doc:
+        total_pages = len(doc)
     
     print(f"PDF has {total_pages} pages")
     
     # Check for existing progress
-    pages_text = []
-    start_page = 0
+    done_pages = {}
     
     if progress_file and progress_file.exists():
         try:
-            with open(progress_file, "r", encoding="utf-8") as f:
-                pages_text = json.load(f)
-            start_page = len(pages_text)
-            if start_page > 0:
-                print(f"Resuming from page {start_page + 1} (found {start_page} previously processed pages)")
+            done_pages = {
+                page_num: page for page_num, page in _load_progress(progress_file).items()
+                if 0 <= page_num < total_pages
+            }
+            if done_pages:
+                print(f"Resuming (found {len(done_pages)} previously processed pages)")
         except Exception as e:
             print(f"Could not load progress file: {e}")
-            pages_text = []
-            start_page = 0
+            done_pages = {}
     
-    if start_page >= total_pages:
+    if len(done_pages) >= total_pages:
         print("All pages already processed!")
-        doc.close()
-        return pages_text
+        yield from (done_pages.pop(page_num) for page_num in range(total_pages))
+        return
     
-    print(f"Processing pages {start_page + 1} to {total_pages} individually...")
+    print(f"Processing {total_pages - len(done_pages)} of {total_pages} pages ({concurrency} concurrent requests)...")
     
-    failed_pages = []
+    done = object()
+    ready = queue.Queue()
+    outcome = {}
     
-    # Process each page individually
-    for page_num in range(start_page, total_pages):
+    def run_ocr():
         try:
-            # Extract single page as PDF
-            single_page_doc = fitz.open()
-            single_page_doc.insert_pdf(doc, from_page=page_num, to_page=page_num)
-            
-            # Convert to bytes
-            pdf_bytes = single_page_doc.tobytes()
-            pdf_base64 = base64.standard_b64encode(pdf_bytes).decode("utf-8")
-            
-            single_page_doc.close()
-            
-            # Call Mistral OCR API for this page
-            response = client.ocr.process(
-                model=OCR_MODEL,
-                document={
-                    "type": "document_url",
-                    "document_url": f"data:application/pdf;base64,{pdf_base64}"
-                }
+            outcome["failed"] = asyncio.run(
+                _ocr_pages_async(pdf_path, total_pages, api_key, done_pages, concurrency,
+                                 progress_file, on_page=ready.put)
             )
-            
-            # Extract text from response
-            if response.pages:
-                page_text = response.pages[0].markdown
-            else:
-                page_text = ""
-            
-            pages_text.append({
-                "page": page_num + 1,
-                "text": page_text
-            })
-            
-            print(f"  ✓ Page {page_num + 1}/{total_pages} - {len(page_text)} chars")
-            
-            # Save progress every 10 pages
-            if progress_file and (page_num + 1) % 10 == 0:
-                with open(progress_file, "w", encoding="utf-8") as f:
-                    json.dump(pages_text, f, ensure_ascii=False)
-                print(f"    [Progress saved at page {page_num + 1}]")
-            
-            # Small delay to avoid rate limiting
-            if (page_num + 1) % 10 == 0:
-                time.sleep(1)
-                
-        except Exception as e:
-            error_msg = str(e)
-            print(f"  ✗ Page {page_num + 1}/{total_pages} - Error: {error_msg[:80]}")
-            failed_pages.append(page_num + 1)
-            pages_text.append({
-                "page": page_num + 1,
-                "text": f"[OCR failed for page {page_num + 1}]"
-            })
-            
-            # Save progress on error
-            if progress_file:
-                with open(progress_file, "w", encoding="utf-8") as f:
-                    json.dump(pages_text, f, ensure_ascii=False)
-            
-            # Wait longer after errors (rate limiting)
-            if "429" in error_msg or "rate" in error_msg.lower():
-                print("    Rate limited, waiting 30 seconds...")
-                time.sleep(30)
-            else:
-                time.sleep(2)
+            ready.put(done)
+        except BaseException as e:
+            ready.put(e)
+    
+    thread = threading.Thread(target=run_ocr, name="ocr", daemon=True)
+    thread.start()
     
-    doc.close()
+    while True:
+        page = ready.get()
+        if page is done:
+            break
+        if isinstance(page, BaseException):
+            raise page
+        yield page
     
-    # Save final progress
-    if progress_file:
-        with open(progress_file, "w", encoding="utf-8") as f:
-            json.dump(pages_text, f, ensure_ascii=False)
+    thread.join()
     
-    print(f"\nOCR complete. Extracted {len(pages_text)} pages.")
+    failed_pages = outcome["failed"]
+    
+    print(f"\nOCR complete. Extracted {total_pages} pages.")
     if failed_pages:
         print(f"Warning: {len(failed_pages)} pages failed: {failed_pages[:10]}{'...' if len(failed_pages) > 10 else ''}")
-    
-    return pages_text
 
 
-def create_vector_store(chunks: list[dict], api_key: str, persist_dir: Path):
-    """Create and populate ChromaDB with Mistral embeddings."""
-    print(f"\nCreating vector store with {len(chunks)} chunks...")
+def extract_text_with_mistral_ocr(
+    pdf_path: Path,
+    api_key: str,
+    progress_file: Path = None,
+    concurrency: int = OCR_CONCURRENCY
+) -> list[dict]:
+    """Extract text from PDF using Mistral OCR API, processing page by page for large PDFs."""
+    return list(iter_ocr_pages(pdf_path, api_key, progress_file, concurrency))
+
+
+def _chunk_id(text: str, start_page: int, end_page: int, section: str, table_header_id: str) -> str:
+    """Content-hash ID for a chunk, stable across re-ingests of an unchanged document."""
+    key = "\0".join((text, str(start_page), str(end_page), section, table_header_id))
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _table_header_id(table_header: str) -> str:
+    """Short content-hash ID under which a table header is stored once ("" for none)."""
+    if not table_header:
+        return ""
+    return hashlib.blake2b(table_header.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def _save_table_headers(path: Path, table_headers: dict[str, str]):
+    """Write the table header ID -> header mapping, replacing the file atomically."""
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(table_headers))
+    tmp_path.replace(path)
+
+
+def create_vector_store(chunks: Iterable[dict], api_key: str, persist_dir: Path):
+    """Create or update ChromaDB with Mistral embeddings.
+    
+    `chunks` may be a generator: each batch is embedded and inserted as soon as it fills up.
+    Chunks already in the collection are skipped (no embedding), and chunks that are no
+    longer produced are removed. Each distinct table header is stored once, in a
+    sidecar file; chunk metadata only refers to it by `table_header_id`.
+    """
+    print("\nCreating vector store...")
     
     # Initialize ChromaDB with persistence
     client = chromadb.PersistentClient(path=str(persist_dir))
     
-    # Delete existing collection if exists
-    try:
-        client.delete_collection(name="tunnel_budget")
-        print("Deleted existing collection.")
-    except Exception:
-        pass
-    
-    # Create collection with Mistral embeddings
-    embedding_fn = MistralEmbeddingFunction(api_key)
-    collection = client.create_collection(
+    # Reuse the existing collection so unchanged chunks need no new embeddings
+    embedding_cache = EmbeddingCache(persist_dir / "embed_cache.sqlite", EMBEDDING_MODEL)
+    embedding_fn = MistralEmbeddingFunction(api_key, cache=embedding_cache)
+    collection = client.get_or_create_collection(
         name="tunnel_budget",
         embedding_function=embedding_fn,
-        metadata={"description": "Tunnel infrastructure budget document"}
+        metadata={
+            "description": "Tunnel infrastructure budget document",
+            "hnsw:M": HNSW_M,
+            "hnsw:construction_ef": HNSW_CONSTRUCTION_EF,
+            "hnsw:search_ef": HNSW_SEARCH_EF
+        }
     )
+    existing_ids = set(collection.get(include=[])["ids"])
+    
+    # Add chunks in batches, several at a time so that ChromaDB writes
+    # overlap with the embedding requests of the other batches.
+    # One batch is embedded as concurrent requests of 10 texts each.
+    batch_size = 100
+    
+    # Batches are kept column-wise; metadata dicts are only built for the chunks written
+    columns = ("ids", "documents", "start_page", "end_page", "section", "table_header_id")
     
-    # Prepare data for insertion
-    ids = [f"chunk_{i}" for i in range(len(chunks))]
-    documents = [c["text"] for c in chunks]
-    metadatas = [{
-        "start_page": c.get("start_page", 0),
-        "end_page": c.get("end_page", 0),
-        "section": c.get("section", "") or "",
-        "table_header": c.get("table_header", "") or ""
-    } for c in chunks]
-    
-    # Add chunks in batches
-    batch_size = 50
-    for i in range(0, len(chunks), batch_size):
-        end_idx = min(i + batch_size, len(chunks))
-        collection.add(
-            ids=ids[i:end_idx],
-            documents=documents[i:end_idx],
-            metadatas=metadatas[i:end_idx]
+    def upsert_batch(batch: dict[str, list]):
+        metadatas = [{
+            "start_page": start_page,
+            "end_page": end_page,
+            "section": section,
+            "table_header_id": table_header_id
+        } for start_page, end_page, section, table_header_id in zip(
+            batch["start_page"], batch["end_page"], batch["section"], batch["table_header_id"]
+        )]
+        # Preformatted source line for the prompt, so queries don't rebuild it
+        for meta in metadatas:
+            meta["context_header"] = format_context_header(meta)
+        collection.upsert(
+            ids=batch["ids"],
+            documents=batch["documents"],
+            metadatas=metadatas
         )
-        print(f"  Added chunks {i+1} to {end_idx}")
+        print(f"  Added {len(batch['ids'])} chunks")
+    
+    seen_ids = set()
+    table_headers = {}
+    with ThreadPoolExecutor(max_workers=INSERT_WORKERS) as executor:
+        futures = []
+        batch = {column: [] for column in columns}
+        for chunk in chunks:
+            text = chunk["text"]
+            start_page = chunk.get("start_page", 0)
+            end_page = chunk.get("end_page", 0)
+            section = chunk.get("section", "") or ""
+            table_header = chunk.get("table_header", "") or ""
+            table_header_id = _table_header_id(table_header)
+            if table_header_id:
+                table_headers[table_header_id] = table_header
+            
+            chunk_id = _chunk_id(text, start_page, end_page, section, table_header_id)
+            if chunk_id in seen_ids:
+                continue
+            seen_ids.add(chunk_id)
+            if chunk_id in existing_ids:
+                continue
+            
+            for column, value in zip(columns, (chunk_id, text, start_page, end_page, section, table_header_id)):
+                batch[column].append(value)
+            if len(batch["ids"]) == batch_size:
+                futures.append(executor.submit(upsert_batch, batch))
+                batch = {column: [] for column in columns}
+        if batch["ids"]:
+            futures.append(executor.submit(upsert_batch, batch))
+        
+        # Surface any insertion errors
+        for future in futures:
+            future.result()
+    
+    _save_table_headers(persist_dir / TABLE_HEADERS_FILE, table_headers)
+    
+    # Remove chunks that are no longer part of the document
+    stale_ids = list(existing_ids - seen_ids)
+    if stale_ids:
+        collection.delete(ids=stale_ids)
+    
+    unchanged = len(seen_ids & existing_ids)
+    print(f"  {unchanged} chunks unchanged, {len(seen_ids) - unchanged} added, {len(stale_ids)} removed")
+    
+    # Cached answers refer to the old chunks
+    if unchanged != len(seen_ids) or stale_ids:
+        shutil.rmtree(ANSWER_CACHE_DIR, ignore_errors=True)
     
     print(f"Vector store created with {collection.count()} chunks.")
     return collection
 
 
-def save_extracted_text(pages: list[dict], output_path: Path):
+@contextmanager
+def extracted_text_writer(output_path: Path) -> Iterator[Callable[[dict], None]]:
+    """Save extracted pages to JSON for inspection, through a function writing one page at a time.
+    
+    The file is completed even if ingestion fails later, so the pages extracted so
+    far can still be inspected.
+    """
+    with open(output_path, "wb") as f:
+        written = 0
+        
+        def write_page(page: dict):
+            nonlocal written
+            # Indented like orjson.OPT_INDENT_2 output for the whole list
+            f.write(b",\n  " if written else b"\n  ")
+            f.write(orjson.dumps(page, option=orjson.OPT_INDENT_2).replace(b"\n", b"\n  "))
+            written += 1
+        
+        f.write(b"[")
+        try:
+            yield write_page
+        finally:
+            f.write(b"\n]" if written else b"]")
+            print(f"Saved extracted text to: {output_path}")
+
+
+def save_extracted_text(pages: Iterable[dict], output_path: Path):
     """Save extracted text to JSON for inspection."""
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(pages, f, ensure_ascii=False, indent=2)
-    print(f"Saved extracted text to: {output_path}")
+    with extracted_text_writer(output_path) as write_page:
+        for page in pages:
+            write_page(page)
 
 
 def main():
@@ -243,45 +647,51 @@ def main():
         print("Please copy 'Tunnel budget.pdf' to the data/ folder.")
         return
     
-    # Step 1: Extract text with OCR
-    print("\n[Step 1/3] Extracting text with Mistral OCR...")
-    progress_file = VECTORSTORE_DIR / "ocr_progress.json"
-    pages = extract_text_with_mistral_ocr(PDF_PATH, MISTRAL_API_KEY, progress_file)
-    
-    # Save extracted text for inspection (final version)
-    save_extracted_text(pages, VECTORSTORE_DIR / "extracted_pages.json")
-    
-    # Step 2: Chunk with table awareness
-    print("\n[Step 2/3] Chunking with table context preservation...")
+    # OCR, chunking and embedding run as one pipeline: each page is chunked as
+    # soon as it is OCR'd, and chunk batches are embedded while OCR continues
+    print("\n[Steps 1-3] OCR -> table-aware chunking -> embedding (pipelined)...")
+    progress_file = VECTORSTORE_DIR / "ocr_progress.jsonl"
     chunker = TableAwareChunker(
         max_chunk_size=MAX_CHUNK_SIZE,
         overlap=CHUNK_OVERLAP
     )
-    chunks = chunker.process_pages(pages)
-    print(f"Created {len(chunks)} chunks from {len(pages)} pages.")
+    
+    page_count = 0
+    chunks_preview = []
+    
+    def ocr_pages() -> Iterator[dict]:
+        # Pages are saved for inspection as they arrive, then only chunked text is kept
+        nonlocal page_count
+        for page in iter_ocr_pages(PDF_PATH, MISTRAL_API_KEY, progress_file):
+            save_page(page)
+            page_count += 1
+            yield page
+    
+    def chunks() -> Iterator[dict]:
+        for i, c in enumerate(chunker.stream(ocr_pages())):
+            chunks_preview.append({
+                "id": i,
+                "text_preview": c["text"][:200] + "..." if len(c["text"]) > 200 else c["text"],
+                "start_page": c.get("start_page"),
+                "end_page": c.get("end_page"),
+                "section": c.get("section"),
+                "has_table_header": bool(c.get("table_header"))
+            })
+            yield c
+    
+    with extracted_text_writer(VECTORSTORE_DIR / "extracted_pages.json") as save_page:
+        collection = create_vector_store(chunks(), MISTRAL_API_KEY, VECTORSTORE_DIR)
+    print(f"Created {len(chunks_preview)} chunks from {page_count} pages.")
     
     # Save chunks for inspection
-    chunks_preview = [{
-        "id": i,
-        "text_preview": c["text"][:200] + "..." if len(c["text"]) > 200 else c["text"],
-        "start_page": c.get("start_page"),
-        "end_page": c.get("end_page"),
-        "section": c.get("section"),
-        "has_table_header": bool(c.get("table_header"))
-    } for i, c in enumerate(chunks)]
-    
-    with open(VECTORSTORE_DIR / "chunks_preview.json", "w", encoding="utf-8") as f:
-        json.dump(chunks_preview, f, ensure_ascii=False, indent=2)
+    with open(VECTORSTORE_DIR / "chunks_preview.json", "wb") as f:
+        f.write(orjson.dumps(chunks_preview, option=orjson.OPT_INDENT_2))
     print(f"Saved chunks preview to: {VECTORSTORE_DIR / 'chunks_preview.json'}")
     
-    # Step 3: Create vector store
-    print("\n[Step 3/3] Creating vector store with embeddings...")
-    collection = create_vector_store(chunks, MISTRAL_API_KEY, VECTORSTORE_DIR)
-    
     print("\n" + "=" * 60)
     print("Ingestion complete!")
-    print(f"  - Pages processed: {len(pages)}")
-    print(f"  - Chunks created: {len(chunks)}")
+    print(f"  - Pages processed: {page_count}")
+    print(f"  - Chunks created: {len(chunks_preview)}")
     print(f"  - Vector store location: {VECTORSTORE_DIR}")
     print("\nYou can now run the app with: streamlit run app.py")
     print("=" * 60)
@@ -1,7 +1,27 @@
 """RAG query functions: retrieve relevant chunks and generate answers."""
 
+import asyncio
+import base64
+import concurrent.futures
+import hashlib
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache, partial
+from operator import itemgetter
+from pathlib import Path
+from itertools import repeat
+from typing import Iterable, Iterator
+
 from mistralai import Mistral
 import chromadb
+import httpx
+import numpy as np
+import orjson
 
 from config import (
     MISTRAL_API_KEY,
@@ -9,94 +29,731 @@ from config import (
     CHAT_MODEL,
     VECTORSTORE_DIR,
     TOP_K_RESULTS,
-    TEMPERATURE
+    TEMPERATURE,
+    QUERY_BATCH_WINDOW_MS,
+    QUERY_MAX_BATCH,
+    ANSWER_CACHE_DIR,
+    TABLE_HEADERS_FILE,
+    SEMANTIC_CACHE_DISTANCE,
+    SEMANTIC_CACHE_TTL,
+    QUERY_EMBEDDING_CACHE_SIZE,
+    ANSWER_CACHE_TTL,
+    EMBEDDING_CONCURRENCY,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_BATCH_CHARS,
+    HNSW_SEARCH_EF,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE,
+    MAX_SOURCE_CHARS,
+    MAX_CONTEXT_CHARS,
+    QUERY_TIMEOUT
 )
+from chunker import format_context_header
+
+
+# Serialization of cached answers, sources and sidecar files (UTF-8 JSON)
+_pack = orjson.dumps
+_unpack = orjson.loads
+
+
+@lru_cache(maxsize=4)
+def _get_mistral(api_key: str) -> Mistral:
+    """Get a shared Mistral client per API key, reusing its connection pool.
+    
+    Sync and async calls each go through one pooled HTTP/2 client, so concurrent
+    requests are multiplexed over already-open TLS connections. The clients are
+    owned by (and closed with) this Mistral instance.
+    """
+    limits = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE)
+    return Mistral(
+        api_key=api_key,
+        client=httpx.Client(http2=True, limits=limits),
+        async_client=httpx.AsyncClient(http2=True, limits=limits)
+    )
 
 
 class MistralEmbeddingFunction:
-    """Custom embedding function for ChromaDB using Mistral."""
+    """Custom embedding function for ChromaDB using Mistral.
+    
+    Inputs too large for one request are sorted by length and packed into
+    micro-batches of at most `batch_size` texts and `batch_chars` characters,
+    sent concurrently (at most `concurrency` in flight).
+    """
     
-    def __init__(self, api_key: str):
-        self.client = Mistral(api_key=api_key)
+    def __init__(self, api_key: str, batch_size: int = EMBEDDING_BATCH_SIZE,
+                 batch_chars: int = EMBEDDING_BATCH_CHARS, concurrency: int = EMBEDDING_CONCURRENCY):
+        self.client = _get_mistral(api_key)
         self.model = EMBEDDING_MODEL
+        self.batch_size = batch_size
+        self.batch_chars = batch_chars
+        self.concurrency = concurrency
+    
+    def _batches(self, input: list[str]) -> list[list[int]]:
+        """Group input indices, longest text first, into request-sized batches."""
+        batches = []
+        batch = []
+        chars = 0
+        for i in sorted(range(len(input)), key=lambda i: len(input[i]), reverse=True):
+            if batch and (len(batch) >= self.batch_size or chars + len(input[i]) > self.batch_chars):
+                batches.append(batch)
+                batch = []
+                chars = 0
+            batch.append(i)
+            chars += len(input[i])
+        batches.append(batch)
+        return batches
+    
+    def embed_one(self, text: str) -> list[float]:
+        """Generate the embedding of a single text (the retrieval path's only case)."""
+        return self.client.embeddings.create(model=self.model, inputs=[text]).data[0].embedding
     
     def __call__(self, input: list[str]) -> list[list[float]]:
         """Generate embeddings for a list of texts."""
+        if len(input) == 1:
+            return [self.embed_one(input[0])]
         if not input:
             return []
+        if len(input) > self.batch_size or sum(map(len, input)) > self.batch_chars:
+            return _run(self.aembed(input))
         
         response = self.client.embeddings.create(
             model=self.model,
             inputs=input
         )
         return [item.embedding for item in response.data]
+    
+    async def aembed(self, input: list[str]) -> list[list[float]]:
+        """Generate embeddings for a list of texts without blocking the event loop."""
+        if not input:
+            return []
+        
+        batches = self._batches(input)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        
+        async def embed(batch: list[int]) -> list[list[float]]:
+            async with semaphore:
+                response = await _on_background_loop(self.client.embeddings.create_async(
+                    model=self.model,
+                    inputs=[input[i] for i in batch]
+                ))
+            return [item.embedding for item in response.data]
+        
+        # Scatter each batch's embeddings back to the input order
+        embeddings = [None] * len(input)
+        for batch, batch_embeddings in zip(batches, await asyncio.gather(*map(embed, batches))):
+            for i, embedding in zip(batch, batch_embeddings):
+                embeddings[i] = embedding
+        return embeddings
+
+
+@lru_cache(maxsize=4)
+def get_embedding_function(api_key: str) -> MistralEmbeddingFunction:
+    """Get a shared embedding function, reusing its Mistral client and connection pool."""
+    return MistralEmbeddingFunction(api_key)
+
+
+# Vector store path -> (PersistentClient, collection), shared by all sessions and reruns
+_CLIENT_CACHE = {}
+_client_cache_lock = threading.Lock()
 
 
 def get_collection():
-    """Get the ChromaDB collection."""
-    client = chromadb.PersistentClient(path=str(VECTORSTORE_DIR))
-    embedding_fn = MistralEmbeddingFunction(MISTRAL_API_KEY)
+    """Get the ChromaDB collection (opened once per process)."""
+    key = str(VECTORSTORE_DIR)
+    with _client_cache_lock:
+        if key not in _CLIENT_CACHE:
+            client = chromadb.PersistentClient(path=key)
+            collection = client.get_collection(
+                name="tunnel_budget",
+                embedding_function=get_embedding_function(MISTRAL_API_KEY)
+            )
+            _set_search_ef(collection, HNSW_SEARCH_EF)
+            _CLIENT_CACHE[key] = (client, collection)
+        return _CLIENT_CACHE[key][1]
+
+
+def _set_search_ef(collection, search_ef: int):
+    """Apply the configured HNSW query-time candidate list size to an existing collection."""
+    metadata = dict(collection.metadata or {})
+    if metadata.get("hnsw:search_ef") == search_ef:
+        return
     
-    return client.get_collection(
-        name="tunnel_budget",
-        embedding_function=embedding_fn
-    )
+    metadata["hnsw:search_ef"] = search_ef  # modify() replaces the whole metadata dict
+    try:
+        collection.modify(metadata=metadata)
+    except Exception as e:
+        # Some Chroma versions can't change HNSW settings after creation; keep the collection's own
+        print(f"Could not set HNSW search_ef on the collection: {e}")
+
+
+_table_headers = {}
+_table_headers_mtime = None
+_table_headers_lock = threading.Lock()
+
+
+def _get_table_headers() -> dict[str, str]:
+    """Get the table header ID -> header mapping written by ingestion (reloaded when it changes)."""
+    global _table_headers, _table_headers_mtime
+    path = VECTORSTORE_DIR / TABLE_HEADERS_FILE
+    with _table_headers_lock:
+        try:
+            mtime = path.stat().st_mtime_ns
+            if mtime != _table_headers_mtime:
+                with open(path, "rb") as f:
+                    _table_headers = _unpack(f.read())
+                _table_headers_mtime = mtime
+        except (OSError, ValueError):
+            pass
+        return _table_headers
+
+
+def _resolve_metadata(meta: dict, table_headers: dict[str, str]) -> dict:
+    """Complete a chunk's metadata with its "table_header" and "context_header".
+    
+    Chunks only store the table header's ID, and chunks from older collections may
+    lack the preformatted context header, so prompt assembly can index both directly.
+    """
+    if "table_header" in meta and "context_header" in meta:
+        return meta
+    meta = dict(meta)
+    if "table_header" not in meta:
+        meta["table_header"] = table_headers.get(meta.get("table_header_id", ""), "")
+    if "context_header" not in meta:
+        meta["context_header"] = format_context_header(meta)
+    return meta
+
+
+def _iter_results(results: dict, row: int = 0, n_results: int = None) -> Iterator[dict]:
+    """Yield one query's row of a ChromaDB result as chunk dicts, up to the `n_results` closest.
+    
+    If documents were not included in the query, each chunk's "document" is None.
+    """
+    distances = results["distances"][row][:n_results]
+    documents = results["documents"][row] if results.get("documents") else repeat(None)
+    table_headers = _get_table_headers()
+    
+    for chunk_id, document, meta, distance in zip(
+        results["ids"][row], documents, results["metadatas"][row], distances
+    ):
+        yield {
+            "id": chunk_id,
+            "document": document,
+            "metadata": _resolve_metadata(meta, table_headers),
+            "distance": distance
+        }
+
+
+def _format_results(results: dict, row: int = 0, n_results: int = None) -> list[dict]:
+    """Format one query's row of a ChromaDB result, keeping the `n_results` closest chunks."""
+    return list(_iter_results(results, row, n_results))
+
+
+class _LRUCache:
+    """Thread-safe mapping that evicts the least recently used entry beyond `maxsize`."""
+    
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+    
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+# Query key (see _qkey) -> embedding as float32 bytes (4 bytes per dimension instead
+# of a list of Python floats), filled by single and batched embedding alike
+_query_embeddings = _LRUCache(QUERY_EMBEDDING_CACHE_SIZE)
+
+
+def _get_query_embedding(key: int) -> np.ndarray | None:
+    """Get a cached query embedding, as a read-only float32 view of the stored bytes."""
+    data = _query_embeddings.get(key)
+    return None if data is None else np.frombuffer(data, dtype=np.float32)
+
+
+def _put_query_embedding(key: int, embedding) -> np.ndarray:
+    """Cache a query embedding, returning it as the same float32 vector later lookups get."""
+    data = np.asarray(embedding, dtype=np.float32).tobytes()
+    _query_embeddings.put(key, data)
+    return np.frombuffer(data, dtype=np.float32)
+
 
+def _normalize_query(query: str) -> str:
+    """Collapse whitespace so trivially different spellings of a query share cache entries."""
+    return " ".join(query.split())
 
-def retrieve_chunks(query: str, collection, n_results: int = TOP_K_RESULTS) -> list[dict]:
-    """Retrieve relevant chunks for a query."""
+
+def _qkey(query: str) -> int:
+    """Stable 64-bit key for a query, ignoring case and whitespace differences.
+    
+    Unlike hash(), the key is the same in every process.
+    """
+    normalized = " ".join(query.lower().split())
+    return int.from_bytes(hashlib.blake2b(normalized.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def _lookup_query_embeddings(normalized_queries: list[str]) -> tuple[list[int], list, dict[int, str]]:
+    """Look up cached query embeddings.
+    
+    Returns the query keys, the embeddings (None where not cached) and the queries to
+    embed by key, so that equivalent queries are embedded once.
+    """
+    keys = [_qkey(query) for query in normalized_queries]
+    embeddings = [_get_query_embedding(key) for key in keys]
+    missing = {key: query for key, query, e in zip(keys, normalized_queries, embeddings) if e is None}
+    return keys, embeddings, missing
+
+
+def _fill_query_embeddings(keys: list[int], embeddings: list, missing: dict[int, str],
+                           fresh: list[list[float]]) -> list[np.ndarray]:
+    """Cache the fresh embeddings of the `missing` queries and scatter them back in query order."""
+    fresh = {key: _put_query_embedding(key, embedding) for key, embedding in zip(missing, fresh)}
+    return [fresh[k] if e is None else e for k, e in zip(keys, embeddings)]
+
+
+def _embed_queries_cached(normalized_queries: list[str], embedding_fn) -> list[np.ndarray]:
+    """Embed normalized queries in one request, reusing the embeddings of recent equivalent queries."""
+    keys, embeddings, missing = _lookup_query_embeddings(normalized_queries)
+    if missing:
+        fresh = embedding_fn(list(missing.values()))
+        embeddings = _fill_query_embeddings(keys, embeddings, missing, fresh)
+    return embeddings
+
+
+async def _aembed_queries_cached(normalized_queries: list[str], embedding_fn) -> list[np.ndarray]:
+    """Like _embed_queries_cached, without blocking the event loop."""
+    keys, embeddings, missing = _lookup_query_embeddings(normalized_queries)
+    if missing:
+        fresh = await embedding_fn.aembed(list(missing.values()))
+        embeddings = _fill_query_embeddings(keys, embeddings, missing, fresh)
+    return embeddings
+
+
+def _embed_query_cached(normalized_query: str) -> np.ndarray:
+    """Embed a normalized query, reusing the embedding of a recent equivalent query."""
+    key = _qkey(normalized_query)
+    embedding = _get_query_embedding(key)
+    if embedding is None:
+        embedding = _put_query_embedding(key, get_embedding_function(MISTRAL_API_KEY).embed_one(normalized_query))
+    return embedding
+
+
+def retrieve_chunks_multi(queries: list[str], collection, n_results: int = TOP_K_RESULTS,
+                          include_documents: bool = True) -> list[dict]:
+    """Retrieve the chunks closest to any of several queries (e.g. reformulations of one question).
+    
+    The queries are embedded in one request (skipping cached ones) and looked up with
+    one batched collection query. A chunk found by several queries is kept once, at its
+    smallest distance, and the `n_results` closest chunks are returned. Callers that
+    only need metadata and distances can pass `include_documents=False` to leave the
+    chunk texts out of the result.
+    """
+    if not queries:
+        return []
+    
+    if len(queries) == 1:
+        embeddings = [_embed_query_cached(_normalize_query(queries[0]))]
+    else:
+        embeddings = _embed_queries_cached(
+            [_normalize_query(query) for query in queries], get_embedding_function(MISTRAL_API_KEY)
+        )
+    include = ["documents", "metadatas", "distances"] if include_documents else ["metadatas", "distances"]
     results = collection.query(
-        query_texts=[query],
+        query_embeddings=[embedding.tolist() for embedding in embeddings],
         n_results=n_results,
-        include=["documents", "metadatas", "distances"]
+        include=include
     )
     
-    # Format results
-    retrieved = []
-    for i in range(len(results["documents"][0])):
-        retrieved.append({
-            "document": results["documents"][0][i],
-            "metadata": results["metadatas"][0][i],
-            "distance": results["distances"][0][i]
-        })
+    # Merge by chunk ID, keeping each chunk's best match
+    best = {}
+    for row in range(len(queries)):
+        for chunk in _iter_results(results, row):
+            if chunk["id"] not in best or chunk["distance"] < best[chunk["id"]]["distance"]:
+                best[chunk["id"]] = chunk
     
-    return retrieved
+    return sorted(best.values(), key=itemgetter("distance"))[:n_results]
 
 
-def generate_answer(query: str, retrieved_chunks: list[dict], api_key: str) -> str:
-    """Generate answer using Mistral Large with retrieved context."""
+def retrieve_chunks(query: str, collection, n_results: int = TOP_K_RESULTS,
+                    include_documents: bool = True) -> list[dict]:
+    """Retrieve relevant chunks for a query (embedded once, or taken from the query embedding cache)."""
+    return retrieve_chunks_multi([query], collection, n_results, include_documents)
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _background_loop() -> asyncio.AbstractEventLoop:
+    """Get the event loop shared by background tasks, starting its thread on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="rag-event-loop", daemon=True).start()
+        return _loop
+
+
+async def _on_background_loop(coro):
+    """Await a coroutine on the shared background loop, from whichever loop is running.
     
-    client = Mistral(api_key=api_key)
+    The async Mistral clients and the query processor are bound to that loop.
+    """
+    loop = _background_loop()
+    if asyncio.get_running_loop() is loop:
+        return await coro
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+
+def _run(coro, timeout: float = QUERY_TIMEOUT):
+    """Run a coroutine on the shared background loop from synchronous code.
     
-    # Build context from retrieved chunks
-    context_parts = []
-    for i, chunk in enumerate(retrieved_chunks, 1):
-        meta = chunk["metadata"]
+    Raises TimeoutError (cancelling the coroutine) if it takes over `timeout` seconds,
+    so a stuck request can't block the calling thread (e.g. a Streamlit session) forever.
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, _background_loop())
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
+
+
+class QueryProcessor:
+    """Coalesces concurrent retrievals into one embedding request and one collection query.
+    
+    Queries arriving within `max_wait_ms` of the first queued one (up to `max_batch`)
+    are embedded together and looked up with a single batched `collection.query`.
+    """
+    
+    def __init__(self, collection, embedding_fn, max_batch: int = QUERY_MAX_BATCH,
+                 max_wait_ms: int = QUERY_BATCH_WINDOW_MS):
+        self.collection = collection
+        self.embedding_fn = embedding_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = None
+        self._tasks = set()  # the loop only keeps weak references to running tasks
+    
+    def _spawn(self, coro):
+        """Start a task on the running loop, keeping it referenced until it is done."""
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _collect_batches(self):
+        """Pull queued queries into batches and dispatch each one."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            # Don't hold up the next batch while this one is in flight
+            self._spawn(self._process_batch(batch))
+    
+    async def _process_batch(self, batch: list[tuple]):
+        """Embed and retrieve a batch of queries, resolving each submitter's future."""
+        loop = asyncio.get_running_loop()
+        queries = [query for query, _, _ in batch]
+        n_results = max(n for _, n, _ in batch)
         
-        # Format page info
-        start_page = meta.get("start_page", "?")
-        end_page = meta.get("end_page", start_page)
-        if start_page == end_page:
-            page_info = f"Page {start_page}"
-        else:
-            page_info = f"Pages {start_page}-{end_page}"
+        try:
+            # Only queries not embedded recently go to the API, each equivalent one once
+            embeddings = await _aembed_queries_cached(queries, self.embedding_fn)
+            results = await loop.run_in_executor(None, partial(
+                self.collection.query,
+                query_embeddings=[embedding.tolist() for embedding in embeddings],
+                n_results=n_results,
+                include=["documents", "metadatas", "distances"]
+            ))
+            for row, (_, n, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result((embeddings[row], _format_results(results, row, n)))
+        except Exception as e:
+            # Every submitter must be resolved, or its caller waits forever
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+    
+    async def submit(self, query: str, n_results: int = TOP_K_RESULTS) -> tuple[np.ndarray, list[dict]]:
+        """Queue a query for the next batch and wait for its embedding and chunks (runs on the processor loop)."""
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._spawn(self._collect_batches())
         
-        # Include section if available
-        section = meta.get("section", "")
-        section_info = f" - {section}" if section else ""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((query, n_results, future))
+        return await future
+    
+    def retrieve(self, query: str, n_results: int = TOP_K_RESULTS) -> tuple[np.ndarray, list[dict]]:
+        """Embed a query and retrieve its chunks from synchronous code (e.g. a Streamlit rerun)."""
+        return _run(self.submit(query, n_results))
+
+
+_query_processor = None
+_query_processor_lock = threading.Lock()
+
+
+def get_query_processor() -> QueryProcessor:
+    """Get the process-wide query processor shared by all sessions."""
+    global _query_processor
+    with _query_processor_lock:
+        if _query_processor is None:
+            _query_processor = QueryProcessor(
+                get_collection(),
+                get_embedding_function(MISTRAL_API_KEY)
+            )
+        return _query_processor
+
+
+def _normalize(embedding) -> np.ndarray:
+    """Convert an embedding to an L2-normalized float32 vector."""
+    vector = np.asarray(embedding, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class SemanticCache:
+    """Caches answers by query embedding so paraphrased repeats skip generation.
+    
+    A cached answer is returned when the closest cached query is within
+    `max_distance` (cosine) and younger than `ttl` seconds. Embeddings are kept
+    as an L2-normalized float32 matrix, so a lookup is one matrix-vector product.
+    Entries are appended to a file under `path`; expired ones are dropped on load.
+    """
+    
+    def __init__(self, path=ANSWER_CACHE_DIR, max_distance: float = SEMANTIC_CACHE_DISTANCE,
+                 ttl: int = SEMANTIC_CACHE_TTL):
+        self.path = Path(path)
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self._entries_file = self.path / "entries.jsonl"
+        self._lock = threading.Lock()
+        self._load()
+    
+    def _reset(self):
+        self._entries = []
+        self._vectors = np.empty((0, 0), dtype=np.float32)
+        self._n_results = np.empty(0, dtype=np.int32)
+        self._created_at = np.empty(0, dtype=np.float64)
+    
+    def _load(self):
+        """Load the persisted entries, dropping expired and unreadable ones."""
+        self._reset()
+        try:
+            with open(self._entries_file, "rb") as f:
+                data = f.read()
+        except OSError:
+            return
+        lines = data.splitlines()
         
-        # Include table header context if available
-        table_header = meta.get("table_header", "")
-        header_info = f"\n[Table columns: {table_header}]" if table_header else ""
+        entries = []
+        vectors = []
+        for line in lines:
+            try:
+                entry = _unpack(line)
+                vector = np.frombuffer(base64.b64decode(entry.pop("vector")), dtype=np.float32)
+                expired = time.time() - entry["created_at"] > self.ttl
+                if not isinstance(entry["n_results"], int) or "answer" not in entry or "sources" not in entry:
+                    continue
+            except (ValueError, KeyError, TypeError, AttributeError):
+                continue  # A record cut off by an interrupted write, or otherwise malformed
+            if vectors and vector.size != vectors[0].size:
+                continue
+            if not expired:
+                entries.append(entry)
+                vectors.append(vector)
         
-        context_parts.append(
-            f"[Source {i}: {page_info}{section_info}]{header_info}\n{chunk['document']}"
-        )
+        if entries:
+            self._entries = entries
+            self._vectors = np.vstack(vectors)
+            self._n_results = np.array([entry["n_results"] for entry in entries], dtype=np.int32)
+            self._created_at = np.array([entry["created_at"] for entry in entries], dtype=np.float64)
+        
+        # Rewrite the file without the dropped records, so they aren't read (and dropped) again
+        if len(entries) < len(lines):
+            self._compact(len(data))
     
-    context = "\n\n---\n\n".join(context_parts)
+    def _compact(self, size: int):
+        """Replace the entries file with the loaded entries, which were read from its first `size` bytes.
+        
+        Records other workers appended since are carried over, and each process
+        writes its own temporary file.
+        """
+        tmp = None
+        try:
+            with tempfile.NamedTemporaryFile(dir=self.path, prefix="entries.", suffix=".tmp", delete=False) as tmp:
+                tmp.writelines(_pack(entry) + b"\n" for entry in self._records())
+                with open(self._entries_file, "rb") as f:
+                    f.seek(size)
+                    tmp.write(f.read())
+            os.replace(tmp.name, self._entries_file)
+        except OSError as e:
+            print(f"Could not rewrite the semantic cache: {e}")
+            if tmp is not None:
+                Path(tmp.name).unlink(missing_ok=True)
+    
+    def _records(self) -> Iterator[dict]:
+        """Yield the in-memory entries as they are persisted, each with its vector."""
+        for entry, vector in zip(self._entries, self._vectors):
+            yield {**entry, "vector": base64.b64encode(vector.tobytes()).decode("ascii")}
+    
+    def lookup(self, embedding: list[float], n_results: int) -> dict | None:
+        """Get the cached answer and sources for the closest query, if close enough."""
+        query = _normalize(embedding)
+        with self._lock:
+            # Ingestion clears the cache directory when the chunks change
+            if self._entries and not self._entries_file.exists():
+                self._reset()
+            if not self._entries:
+                return None
+            
+            scores = self._vectors @ query
+            valid = (self._n_results == n_results) & (self._created_at >= time.time() - self.ttl)
+            scores = np.where(valid, scores, -np.inf)
+            best = int(scores.argmax())
+            if scores[best] < 1 - self.max_distance:
+                return None
+            entry = self._entries[best]
+        
+        return {"answer": entry["answer"], "sources": entry["sources"]}
+    
+    def add(self, query: str, embedding: list[float], n_results: int, answer: str, sources: list[dict]):
+        """Cache an answer and its sources under the query embedding."""
+        vector = _normalize(embedding)
+        entry = {
+            "query": query,
+            "n_results": n_results,
+            "created_at": time.time(),
+            "answer": answer,
+            "sources": sources
+        }
+        # The vector travels in the same record, written with a single append, so
+        # records from concurrent workers can't pair one query's vector with another's answer
+        record = _pack({**entry, "vector": base64.b64encode(vector.tobytes()).decode("ascii")}) + b"\n"
+        
+        with self._lock:
+            try:
+                self.path.mkdir(parents=True, exist_ok=True)
+                flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0)
+                fd = os.open(self._entries_file, flags, 0o644)
+                try:
+                    os.write(fd, record)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                # Still cached in this process; the answer itself is not affected
+                print(f"Could not write the semantic cache: {e}")
+            
+            self._entries.append(entry)
+            self._vectors = np.vstack([self._vectors, vector[None]]) if self._vectors.size else vector[None]
+            self._n_results = np.append(self._n_results, np.int32(n_results))
+            self._created_at = np.append(self._created_at, entry["created_at"])
+
+
+_semantic_cache = None
+_semantic_cache_lock = threading.Lock()
+
+
+def get_semantic_cache() -> SemanticCache:
+    """Get the process-wide semantic answer cache."""
+    global _semantic_cache
+    with _semantic_cache_lock:
+        if _semantic_cache is None:
+            _semantic_cache = SemanticCache()
+        return _semantic_cache
+
+
+class AnswerCache:
+    """SQLite-backed store of answers keyed by the exact (normalized) query, shared by all workers.
+    
+    Entries expire after `ttl` seconds. A connection is opened per operation, so that
+    the cache file being removed by ingestion takes effect in every process. The cache
+    is best-effort: a database error is reported and treated as a miss, never as a
+    failed query. Calls block, so async code runs them in an executor.
+    """
+    
+    def __init__(self, path: Path = ANSWER_CACHE_DIR / "answers.sqlite", ttl: int = ANSWER_CACHE_TTL):
+        self.path = Path(path)
+        self.ttl = ttl
+        self._schema_ready = False
     
-    # System prompt for RAG
-    system_prompt = """You are a helpful assistant analyzing a construction infrastructure budget document.
+    def _connect(self) -> sqlite3.Connection:
+        # The schema is set up once, and again if ingestion has removed the file since
+        setup = not self._schema_ready or not self.path.exists()
+        if setup:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.path), timeout=5)
+        if setup:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                "key BLOB, n_results INTEGER, created_at REAL, answer TEXT, sources BLOB, "
+                "PRIMARY KEY (key, n_results))"
+            )
+            self._schema_ready = True
+        return conn
+    
+    def get(self, key: int, n_results: int) -> dict | None:
+        """Get the cached answer and sources for a query key, if not expired."""
+        if not self.path.exists():
+            return None
+        try:
+            conn = self._connect()
+            try:
+                row = conn.execute(
+                    "SELECT answer, sources FROM answers WHERE key = ? AND n_results = ? AND created_at >= ?",
+                    (key.to_bytes(8, "big"), n_results, time.time() - self.ttl)
+                ).fetchone()
+            finally:
+                conn.close()
+        except (sqlite3.Error, OSError) as e:
+            print(f"Could not read the answer cache: {e}")
+            return None
+        if row is None:
+            return None
+        return {"answer": row[0], "sources": _unpack(row[1])}
+    
+    def set(self, key: int, n_results: int, answer: str, sources: list[dict]):
+        """Cache an answer and its sources under a query key."""
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO answers (key, n_results, created_at, answer, sources) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (key.to_bytes(8, "big"), n_results, time.time(), answer, _pack(sources))
+                    )
+            finally:
+                conn.close()
+        except (sqlite3.Error, OSError) as e:
+            print(f"Could not write the answer cache: {e}")
+
+
+_answer_cache = AnswerCache()
+
+
+# System prompt for RAG
+_SYSTEM_PROMPT = """You are a helpful assistant analyzing a construction infrastructure budget document.
 
 Your task is to answer questions based ONLY on the provided context from the document.
 
@@ -112,7 +769,7 @@ Format your response clearly with:
 - Supporting details from the document
 - Page references for verification"""
 
-    user_message = f"""Context from the construction budget document:
+_USER_TEMPLATE = """Context from the construction budget document:
 
 {context}
 
@@ -122,54 +779,261 @@ Question: {query}
 
 Please provide a comprehensive answer based on the context above."""
 
+
+def _truncate_source(text: str, max_chars: int) -> str:
+    """Cut text to about `max_chars`, keeping its head and tail (where table totals often are).
+    
+    Cuts are moved back to line boundaries where possible, so table rows stay whole.
+    """
+    if len(text) <= max_chars:
+        return text
+    
+    half = max_chars // 2
+    head_end = text.rfind("\n", 0, half)
+    tail_start = text.find("\n", len(text) - half)
+    head = text[:head_end] if head_end > 0 else text[:half]
+    tail = text[tail_start + 1:] if tail_start != -1 else text[len(text) - half:]
+    return f"{head}\n...\n{tail}"
+
+
+# Metadata read per source; _resolve_metadata guarantees both keys
+_mget = itemgetter("context_header", "table_header")
+
+
+def _fit_sources(retrieved_chunks: Iterable[dict]) -> list[tuple[dict, str]]:
+    """Pick the chunks that fit in the prompt, each with its text as it is sent.
+    
+    Each source is cut to MAX_SOURCE_CHARS, and sources are added closest first until
+    MAX_CONTEXT_CHARS of source text is used. `retrieved_chunks` is iterated once, so
+    it can be a generator (e.g. over a ChromaDB result).
+    """
+    fitted = []
+    remaining = MAX_CONTEXT_CHARS
+    for chunk in retrieved_chunks:
+        if remaining <= 0:
+            break
+        document = _truncate_source(chunk["document"], min(MAX_SOURCE_CHARS, remaining))
+        remaining -= len(document)
+        fitted.append((chunk, document))
+    return fitted
+
+
+def _used_sources(retrieved_chunks: Iterable[dict]) -> list[dict]:
+    """Keep the retrieved chunks that fit in the prompt, i.e. the sources the answer can cite."""
+    return [chunk for chunk, _ in _fit_sources(retrieved_chunks)]
+
+
+def _build_messages(query: str, retrieved_chunks: Iterable[dict]) -> list[dict]:
+    """Build the chat messages asking the question over the retrieved context (see _fit_sources)."""
+    
+    # Build context from retrieved chunks
+    context_parts = []
+    for i, (chunk, document) in enumerate(_fit_sources(retrieved_chunks), 1):
+        context_header, table_header = _mget(chunk["metadata"])
+        
+        # Source line preformatted at ingestion (see _resolve_metadata)
+        source_info = context_header.replace("{i}", str(i), 1)
+        
+        # Include table header context if available
+        if table_header:
+            source_info += f"\n[Table columns: {table_header}]"
+        
+        context_parts.append(source_info + "\n" + document)
+    
+    context = "\n\n---\n\n".join(context_parts)
+    
+    user_message = _USER_TEMPLATE.format_map({"context": context, "query": query})
+    
+    return [
+        {"role": "system", "content": _SYSTEM_PROMPT},
+        {"role": "user", "content": user_message}
+    ]
+
+
+def generate_answer(query: str, retrieved_chunks: Iterable[dict], api_key: str) -> str:
+    """Generate answer using Mistral Large with retrieved context."""
+    
+    client = _get_mistral(api_key)
+    
     # Generate response
     response = client.chat.complete(
         model=CHAT_MODEL,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_message}
-        ],
+        messages=_build_messages(query, retrieved_chunks),
         temperature=TEMPERATURE
     )
     
     return response.choices[0].message.content
 
 
-def query_rag(query: str, n_results: int = TOP_K_RESULTS) -> dict:
-    """Full RAG pipeline: retrieve + generate."""
+async def agenerate_answer(query: str, retrieved_chunks: Iterable[dict], api_key: str) -> str:
+    """Generate answer using Mistral Large with retrieved context, without blocking the event loop."""
+    
+    client = _get_mistral(api_key)
+    
+    # Generate response
+    response = await _on_background_loop(client.chat.complete_async(
+        model=CHAT_MODEL,
+        messages=_build_messages(query, retrieved_chunks),
+        temperature=TEMPERATURE
+    ))
+    
+    return response.choices[0].message.content
+
+
+def generate_answer_stream(query: str, retrieved_chunks: Iterable[dict], api_key: str) -> Iterator[str]:
+    """Generate answer using Mistral Large with retrieved context, yielding text as it arrives."""
+    
+    client = _get_mistral(api_key)
+    
+    # Stream the response
+    with client.chat.stream(
+        model=CHAT_MODEL,
+        messages=_build_messages(query, retrieved_chunks),
+        temperature=TEMPERATURE
+    ) as events:
+        for event in events:
+            content = event.data.choices[0].delta.content
+            if content:
+                yield content
+
+
+async def _aretrieve_or_cached(query: str, n_results: int) -> tuple[np.ndarray | None, list[dict], dict | None]:
+    """Get the query embedding and either a cached answer or the retrieved chunks to answer from.
+    
+    The embedding is None for an exact repeat answered from the shared answer cache.
+    """
     
-    # Get collection
-    collection = get_collection()
+    normalized = _normalize_query(query)
+    key = _qkey(normalized)
+    processor = get_query_processor()
     
-    # Retrieve relevant chunks
-    retrieved = retrieve_chunks(query, collection, n_results)
+    # Exact repeats, asked in any worker, need neither an embedding nor retrieval
+    cached = await asyncio.get_running_loop().run_in_executor(None, _answer_cache.get, key, n_results)
+    if cached:
+        return None, cached["sources"], cached
     
-    # Generate answer
-    answer = generate_answer(query, retrieved, MISTRAL_API_KEY)
+    # A repeated query's embedding is known already, so its cached answer costs no API call;
+    # otherwise embed and retrieve (batched with any concurrent queries)
+    retrieved = None
+    embedding = _get_query_embedding(key)
+    if embedding is None:
+        embedding, retrieved = await _on_background_loop(processor.submit(normalized, n_results))
+    
+    # Serve paraphrased repeats from the cache, reusing the query embedding
+    cache = get_semantic_cache()
+    cached = cache.lookup(embedding, n_results)
+    if cached:
+        return embedding, cached["sources"], cached
+    
+    if retrieved is None:
+        _, retrieved = await _on_background_loop(processor.submit(normalized, n_results))
+    return embedding, retrieved, None
+
+
+def _cache_answer(query: str, embedding: np.ndarray, n_results: int, answer: str, sources: list[dict]):
+    """Store a generated answer in the shared exact-query cache and the semantic cache."""
+    _answer_cache.set(_qkey(_normalize_query(query)), n_results, answer, sources)
+    get_semantic_cache().add(query, embedding, n_results, answer, sources)
+
+
+async def aquery_rag(query: str, n_results: int = TOP_K_RESULTS) -> dict:
+    """Full RAG pipeline: retrieve + generate (async; can be awaited from any event loop)."""
+    
+    embedding, retrieved, cached = await _aretrieve_or_cached(query, n_results)
+    if cached:
+        return {
+            "answer": cached["answer"],
+            "sources": cached["sources"],
+            "query": query,
+            "cached": True
+        }
+    
+    # Generate answer (sources left out of the prompt aren't returned or cached as evidence)
+    retrieved = _used_sources(retrieved)
+    answer = await agenerate_answer(query, retrieved, MISTRAL_API_KEY)
+    await asyncio.get_running_loop().run_in_executor(
+        None, _cache_answer, query, embedding, n_results, answer, retrieved
+    )
     
     return {
         "answer": answer,
         "sources": retrieved,
-        "query": query
+        "query": query,
+        "cached": False
+    }
+
+
+async def aquery_rag_many(queries: list[str], n_results: int = TOP_K_RESULTS) -> list[dict]:
+    """Run the RAG pipeline for several queries concurrently, returning results in query order.
+    
+    Queries differing only in case or whitespace are answered once.
+    """
+    unique = {}
+    for query in queries:
+        unique.setdefault(_qkey(query), query)
+    results = dict(zip(unique, await asyncio.gather(*[aquery_rag(query, n_results) for query in unique.values()])))
+    return [{**results[_qkey(query)], "query": query} for query in queries]
+
+
+def query_rag(query: str, n_results: int = TOP_K_RESULTS, stream: bool = False) -> dict:
+    """Full RAG pipeline: retrieve + generate.
+    
+    With `stream=True`, "answer" is an iterator of text pieces as they are generated
+    (a single piece for a cached answer); the answer is cached once it has been
+    read to the end.
+    """
+    if not stream:
+        return _run(aquery_rag(query, n_results))
+    
+    embedding, retrieved, cached = _run(_aretrieve_or_cached(query, n_results))
+    if cached:
+        return {
+            "answer": iter([cached["answer"]]),
+            "sources": cached["sources"],
+            "query": query,
+            "cached": True
+        }
+    
+    # Sources left out of the prompt aren't returned or cached as evidence
+    retrieved = _used_sources(retrieved)
+    
+    def answer() -> Iterator[str]:
+        parts = []
+        for part in generate_answer_stream(query, retrieved, MISTRAL_API_KEY):
+            parts.append(part)
+            yield part
+        _cache_answer(query, embedding, n_results, "".join(parts), retrieved)
+    
+    return {
+        "answer": answer(),
+        "sources": retrieved,
+        "query": query,
+        "cached": False
     }
 
 
 # Example usage
 if __name__ == "__main__":
-    # Test query
+    # Test query (set RAG_PROFILE=1 to profile the pipeline without the demo's output)
     test_query = "What is the total budget for tunnel construction?"
     
-    print(f"Query: {test_query}")
-    print("-" * 50)
+    profiler = None
+    if os.getenv("RAG_PROFILE"):
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
     
     result = query_rag(test_query)
     
-    print("\nAnswer:")
-    print(result["answer"])
+    if profiler is not None:
+        profiler.disable()
     
-    print("\n" + "-" * 50)
-    print("Sources:")
+    lines = [f"Query: {test_query}", "-" * 50, "", "Answer:", result["answer"], "", "-" * 50, "Sources:"]
     for i, source in enumerate(result["sources"], 1):
         meta = source["metadata"]
-        print(f"\n[{i}] Page {meta.get('start_page', '?')} (distance: {source['distance']:.3f})")
-        print(f"    Preview: {source['document'][:150]}...")
+        lines.append(f"\n[{i}] Page {meta.get('start_page', '?')} (distance: {source['distance']:.3f})")
+        lines.append(f"    Preview: {source['document'][:150]}...")
+    sys.stdout.write("\n".join(lines) + "\n")
+    
+    if profiler is not None:
+        profiler.print_stats("cumulative")